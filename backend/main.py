@@ -1,28 +1,56 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import os
+
+# Must be set before numpy or torch is imported: BLAS/OpenMP size their thread
+# pools on first import. Each uvicorn worker is a separate process, so split
+# the cores across WEB_CONCURRENCY workers instead of giving every worker all of them
+CPU_THREADS = max(1, (os.cpu_count() or 1) // max(1, int(os.getenv("WEB_CONCURRENCY", "1"))))
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
-import os
+from typing import Optional, List, Dict, Any, Tuple
+import asyncio
 import tempfile
 import json
 from datetime import datetime
 import re
+import shutil
+import threading
+import functools
+from dataclasses import dataclass
+from collections import defaultdict
+import hashlib
+import uuid
+
+import numpy as np
+import orjson
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain_core.documents import Document as LangchainDocument
+from langchain_core.embeddings import Embeddings
 
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.chains import RetrievalQA
 from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="Ultra Doc-Intelligence API", version="2.0.0")
+app = FastAPI(
+    title="Ultra Doc-Intelligence API",
+    version="2.0.0",
+    default_response_class=ORJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,44 +60,312 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-vector_store = None
-current_document_name = None
-embeddings = None  
+@dataclass
+class State:
+    """Process-wide mutable singletons, mutated by attribute instead of `global` rebinding"""
+    vector_store: Optional[Chroma] = None
+    embeddings: Optional[Embeddings] = None
+    # Short identity of the loaded embedding model; names its Chroma collection
+    embeddings_model: Optional[str] = None
+    latest_document_id: Optional[str] = None
+    genai_client: Any = None
+
+
+STATE = State()
+# Uploaded documents: document_id -> filename. Chunks carry both in metadata["doc"] and
+# metadata["filename"], so this is rebuilt from the persistent collection on open
+documents: Dict[str, str] = {}
+_documents_lock = threading.Lock()
+# Per-document ingest locks, created under _documents_lock
+_document_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+_embeddings_lock = threading.Lock()
+_vector_store_lock = threading.Lock()
+# Gemini chat clients keyed by max_output_tokens
+llm_clients: Dict[Optional[int], ChatGoogleGenerativeAI] = {}
+# Batch extraction jobs: job_id -> Gemini batch job name
+batch_jobs: Dict[str, str] = {}
+# Parsed results of succeeded batch jobs: batch job name -> document_id -> StructuredData or error
+batch_results: Dict[str, Dict[str, Any]] = {}
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+EMBED_BATCH_SIZE = 64
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./onnx_models/all-MiniLM-L6-v2-int8")
+ONNX_MODEL_FILE = "model_quantized.onnx"
+ONNX_CACHE_FILES = (ONNX_MODEL_FILE, "tokenizer.json", "tokenizer_config.json")
+CHROMA_DIR = os.getenv("CHROMA_DIR", "./chroma")
+COLLECTION_NAME = "logistics_docs"
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    # Wider than Chroma's default of 10: costs some query latency, but filtered
+    # per-document searches with a small ef can return fewer than k results
+    "hnsw:search_ef": 64,
+}
+QA_CACHE_SIMILARITY = 0.97
+QA_CACHE_MAX_ENTRIES = 256  # per document
+
+def _onnx_cache_complete(cache_dir: str) -> bool:
+    """True if cache_dir holds both the quantized model and its tokenizer"""
+    return all(os.path.exists(os.path.join(cache_dir, name)) for name in ONNX_CACHE_FILES)
+
+
+class QuantizedMiniLMEmbeddings(Embeddings):
+    """
+    all-MiniLM-L6-v2 exported to ONNX with dynamic int8 quantization.
+    The quantized model is built once and cached in ONNX_MODEL_DIR.
+    Requires `optimum[onnxruntime]`.
+    """
+
+    def __init__(self, model_name: str = EMBED_MODEL_NAME, cache_dir: str = ONNX_MODEL_DIR):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        if not _onnx_cache_complete(cache_dir):
+            print("📦 Exporting and quantizing embeddings model to ONNX...")
+            # Build in a sibling temp dir and rename it into place, so a crash or a
+            # concurrent worker never leaves a model without its tokenizer
+            parent = os.path.dirname(os.path.abspath(cache_dir))
+            os.makedirs(parent, exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=".onnx-export-", dir=parent)
+            try:
+                model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+                quantizer = ORTQuantizer.from_pretrained(model)
+                # ONNX Runtime uses VNNI int8 kernels when available, AVX2 otherwise
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=staging, quantization_config=qconfig)
+                AutoTokenizer.from_pretrained(model_name).save_pretrained(staging)
+
+                if os.path.isdir(cache_dir) and not _onnx_cache_complete(cache_dir):
+                    # Partial export left by an older, non-atomic build
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                try:
+                    os.replace(staging, cache_dir)
+                except OSError:
+                    # Another worker's export landed first; use it
+                    if not _onnx_cache_complete(cache_dir):
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        # ONNX Runtime ignores OMP_NUM_THREADS and torch's setting and uses every core by default
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = CPU_THREADS
+        session_options.inter_op_num_threads = 1
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            cache_dir, file_name=ONNX_MODEL_FILE, session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        import torch
+
+        # Length-sort so each batch is only padded to its own longest text
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+
+        for start in range(0, len(order), EMBED_BATCH_SIZE):
+            batch_idx = order[start:start + EMBED_BATCH_SIZE]
+            inputs = self.tokenizer(
+                [texts[i] for i in batch_idx],
+                padding=True,
+                truncation=True,
+                max_length=256,
+                return_tensors="pt",
+            )
+            with torch.no_grad():
+                hidden = self.model(**inputs).last_hidden_state
+
+            # Mean pooling + L2 normalisation, matching sentence-transformers
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+
+            for i, vec in zip(batch_idx, pooled.tolist()):
+                vectors[i] = vec
+
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+def _load_local_embeddings():
+    """Prefer the int8 ONNX model; fall back to the FP32 PyTorch model."""
+    try:
+        local = QuantizedMiniLMEmbeddings()
+        print("✅ Quantized ONNX embeddings loaded successfully")
+        return local
+    except Exception as e:
+        print(f"⚠️ Failed to load quantized ONNX embeddings: {e}")
+
+    local = HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL_NAME,
+        model_kwargs={'device': 'cpu'},
+        # sentence-transformers length-sorts texts before batching, so
+        # each batch is only padded to its own longest chunk
+        encode_kwargs={
+            'normalize_embeddings': True,
+            'batch_size': EMBED_BATCH_SIZE,
+        }
+    )
+    print("✅ HuggingFace embeddings loaded successfully")
+    return local
+
+
+def _configure_torch_threads():
+    """Use this worker's share of cores for intra-op work; uvicorn workers can otherwise leave torch at 1 thread."""
+    try:
+        import torch
+    except ImportError:
+        return
+
+    torch.set_num_threads(CPU_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only settable once, before any inter-op parallel work has started
+        pass
+
 
 def get_embeddings():
     """
     Lazy load embeddings only when needed.
-    Uses HuggingFace embeddings with proper 2025 import.
+    Uses local MiniLM embeddings (int8 ONNX, else HuggingFace).
+    Thread-safe: ingest runs in worker threads, so only one may load the model.
     """
-    global embeddings
-    if embeddings is None:
-        try:
-            embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2",
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
-            print("✅ HuggingFace embeddings loaded successfully")
-        except Exception as e:
-            print(f"⚠️ Failed to load HuggingFace embeddings: {e}")
-            # Fallback to Google embeddings if available
+    if STATE.embeddings is not None:
+        return STATE.embeddings
+
+    with _embeddings_lock:
+        if STATE.embeddings is None:
+            _configure_torch_threads()
             try:
-                from langchain_google_genai import GoogleGenerativeAIEmbeddings
-                embeddings = GoogleGenerativeAIEmbeddings(
-                    model="models/embedding-001",
-                    google_api_key=os.getenv("GEMINI_API_KEY")
+                loaded = _load_local_embeddings()
+                STATE.embeddings_model = (
+                    "minilm-onnx-int8" if isinstance(loaded, QuantizedMiniLMEmbeddings) else "minilm-fp32"
                 )
-                print("✅ Google embeddings loaded as fallback")
-            except Exception as e2:
+                STATE.embeddings = loaded
+            except Exception as e:
+                print(f"⚠️ Failed to load local embeddings: {e}")
+                # Fallback to Google embeddings if available
+                try:
+                    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+                    loaded = GoogleGenerativeAIEmbeddings(
+                        model="models/embedding-001",
+                        google_api_key=os.getenv("GEMINI_API_KEY")
+                    )
+                    STATE.embeddings_model = "google-embedding-001"
+                    STATE.embeddings = loaded
+                    print("✅ Google embeddings loaded as fallback")
+                except Exception as e2:
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Could not initialize any embeddings. Error: {str(e2)}"
+                    )
+    return STATE.embeddings
+
+
+def get_llm(max_output_tokens: Optional[int] = None) -> ChatGoogleGenerativeAI:
+    """
+    Shared Gemini chat client, one per output-token limit.
+    Reused across requests so the underlying connection stays open.
+    """
+    llm = llm_clients.get(max_output_tokens)
+    if llm is None:
+        llm = ChatGoogleGenerativeAI(
+            model="gemini-2.5-flash",
+            temperature=0,
+            google_api_key=os.getenv("GEMINI_API_KEY"),
+            max_output_tokens=max_output_tokens
+        )
+        llm_clients[max_output_tokens] = llm
+    return llm
+
+
+def get_vector_store() -> Chroma:
+    """
+    Open the persistent Chroma collection once and reuse it across uploads,
+    so the HNSW index is extended incrementally instead of rebuilt.
+    Each embedding model gets its own collection, so a fallback model on a
+    later boot never mixes its vectors with another model's.
+    """
+    if STATE.vector_store is not None:
+        return STATE.vector_store
+
+    with _vector_store_lock:
+        if STATE.vector_store is None:
+            embedding_function = get_embeddings()
+            dimension = len(embedding_function.embed_query("dimension probe"))
+            store = Chroma(
+                collection_name=f"{COLLECTION_NAME}_{STATE.embeddings_model}",
+                embedding_function=embedding_function,
+                persist_directory=CHROMA_DIR,
+                collection_metadata={
+                    **HNSW_METADATA,
+                    "embedding_model": STATE.embeddings_model,
+                    "embedding_dim": dimension,
+                },
+            )
+            
+            # An existing collection keeps the metadata it was created with
+            stored = store._collection.metadata or {}
+            if (stored.get("embedding_model"), stored.get("embedding_dim")) != (STATE.embeddings_model, dimension):
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Could not initialize any embeddings. Error: {str(e2)}"
+                    detail=(
+                        f"Vector store was built with {stored.get('embedding_model')} "
+                        f"({stored.get('embedding_dim')} dims), but {STATE.embeddings_model} "
+                        f"({dimension} dims) is loaded. Clear {CHROMA_DIR} to rebuild it."
+                    )
                 )
-    return embeddings
+            # The collection outlives the process; restore the documents it already holds
+            with _documents_lock:
+                for metadata in store.get(include=["metadatas"])["metadatas"]:
+                    documents.setdefault(metadata["doc"], metadata.get("filename", ""))
+            STATE.vector_store = store
+            print(f"✅ Vector store opened successfully ({STATE.embeddings_model}, {dimension} dims)")
+    return STATE.vector_store
+
+
+def chunk_id(document_id: str, content: str) -> str:
+    """Stable chunk ID, so re-uploading an unchanged document skips re-embedding"""
+    return hashlib.blake2b(f"{document_id}\0{content}".encode(), digest_size=16).hexdigest()
+
+
+async def resolve_document(document_id: Optional[str]) -> str:
+    """
+    Map a request's document_id to a known document.
+    Falls back to the most recently uploaded document when none is given.
+    """
+    if document_id is None:
+        document_id = STATE.latest_document_id
+    if document_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail="No document uploaded. Please upload a document first."
+        )
+    # Opening the store restores documents indexed before a restart; the first
+    # open loads the embeddings model, so keep it off the event loop
+    await asyncio.to_thread(get_vector_store)
+    if document_id not in documents:
+        raise HTTPException(status_code=404, detail=f"Document not found: {document_id}")
+    return document_id
+
 
 # Pydantic models
 class QuestionRequest(BaseModel):
     question: str = Field(..., description="Question about the document")
+    document_id: Optional[str] = Field(None, description="Document to ask about; defaults to the latest upload")
+
+class ExtractRequest(BaseModel):
+    document_id: Optional[str] = Field(None, description="Document to extract from; defaults to the latest upload")
     
 class AnswerResponse(BaseModel):
     answer: str
@@ -77,6 +373,9 @@ class AnswerResponse(BaseModel):
     confidence: float
     metadata: Dict[str, Any]
 
+class BatchExtractRequest(BaseModel):
+    document_ids: List[str] = Field(..., description="IDs of uploaded documents to extract")
+
 class StructuredData(BaseModel):
     shipment_id: Optional[str] = None
     shipper: Optional[str] = None
@@ -91,6 +390,67 @@ class StructuredData(BaseModel):
     carrier_name: Optional[str] = None
 
 
+# Semantic cache for /ask: document_id -> [(question vector, response)]
+qa_cache: Dict[str, List[Tuple[np.ndarray, AnswerResponse]]] = {}
+# Bumped whenever a document's content changes; answers computed against an
+# older generation are not cached
+qa_cache_generation: Dict[str, int] = defaultdict(int)
+
+
+def lookup_cached_answer(document_id: str, question_vec: np.ndarray) -> Optional[AnswerResponse]:
+    """Return a cached answer for a near-duplicate question about the same document"""
+    entries = qa_cache.get(document_id)
+    if not entries:
+        return None
+    
+    similarities = np.stack([vec for vec, _ in entries]) @ question_vec
+    best = int(np.argmax(similarities))
+    if similarities[best] >= QA_CACHE_SIMILARITY:
+        return entries[best][1]
+    return None
+
+
+def invalidate_cached_answers(document_id: str):
+    qa_cache_generation[document_id] += 1
+    qa_cache.pop(document_id, None)
+
+
+def store_cached_answer(
+    document_id: str,
+    question_vec: np.ndarray,
+    response: AnswerResponse,
+    generation: int
+):
+    """Cache an answer unless the document was replaced while it was being computed"""
+    if qa_cache_generation[document_id] != generation:
+        return
+    entries = qa_cache.setdefault(document_id, [])
+    entries.append((question_vec, response))
+    if len(entries) > QA_CACHE_MAX_ENTRIES:
+        del entries[0]
+
+
+# RAG prompt (using langchain_core.prompts). Kept terse: Gemini latency scales with input tokens
+RAG_PROMPT = PromptTemplate(
+    template="""Answer from the logistics document context only. Say "Not found in document" if absent.
+{context}
+Q: {question}
+A:""",
+    input_variables=["context", "question"]
+)
+
+RETRIEVAL_K = 3
+# MMR: fetch a wider candidate set, then keep RETRIEVAL_K diverse chunks
+MMR_FETCH_K = 10
+MMR_LAMBDA = 0.5
+CONTEXT_CHARS_PER_CHUNK = 400
+# Gemini 2.5 thinking tokens count towards this limit, so leave headroom beyond the answer itself
+ASK_MAX_OUTPUT_TOKENS = 1024
+EXTRACT_CONTEXT_CHARS = 4000
+
+CONFIDENCE_THRESHOLD = 0.3
+
+
 def load_document(file_path: str, filename: str) -> List[LangchainDocument]:
     """Load document based on file type"""
     ext = filename.lower().split('.')[-1]
@@ -110,25 +470,128 @@ def load_document(file_path: str, filename: str) -> List[LangchainDocument]:
         raise HTTPException(status_code=400, detail=f"Error loading document: {str(e)}")
 
 
+_BLANK_LINES_RE = re.compile(r"\n\s*\n\s*")
+# Preferred window boundaries, best first
+_BREAKS = ("\n\n", "\n", " ")
+
+
+def _window_end(text: str, start: int, size: int) -> int:
+    """
+    End of the window starting at `start`: the last paragraph, line or word
+    break in the second half of the window, else a hard cut at `size`.
+    Searching only the second half keeps every non-final window >= size/2.
+    """
+    limit = start + size
+    if limit >= len(text):
+        return len(text)
+    for brk in _BREAKS:
+        cut = text.rfind(brk, start + size // 2, limit)
+        if cut != -1:
+            return cut
+    return limit
+
+
+def fast_chunk(
+    documents: List[LangchainDocument],
+    size: int = 500,
+    overlap: int = 100
+) -> List[LangchainDocument]:
+    """
+    Single-pass chunker: slide windows of up to `size` chars over each page,
+    ending on paragraph/line/word breaks, and start each window with the
+    last `overlap` chars of the previous one (trimmed to a word boundary).
+    """
+    chunks = []
+    for doc in documents:
+        text = _BLANK_LINES_RE.sub("\n\n", doc.page_content).strip()
+        start = 0
+        while start < len(text):
+            end = _window_end(text, start, size)
+            content = text[start:end].strip()
+            if content:
+                chunks.append(LangchainDocument(page_content=content, metadata=dict(doc.metadata)))
+            if end >= len(text):
+                break
+            
+            # Next window re-reads the tail of this one, starting after a whitespace
+            next_start = max(end - overlap, start + 1)
+            breaks = [i for i in (text.find(" ", next_start, end), text.find("\n", next_start, end)) if i != -1]
+            if breaks:
+                next_start = min(breaks) + 1
+            while next_start < len(text) and text[next_start].isspace():
+                next_start += 1
+            start = next_start
+    return chunks
+
+
 def chunk_document(documents: List[LangchainDocument]) -> List[LangchainDocument]:
     """
     Intelligent chunking strategy for logistics documents.
-    Uses RecursiveCharacterTextSplitter from langchain_text_splitters (2025).
+    500-char chunks with 100-char overlap, on paragraph boundaries where possible.
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=100,
-        length_function=len,
-        separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
-    )
+    return fast_chunk(documents, size=500, overlap=100)
+
+
+_WORD_RE = re.compile(r"\w+")
+_UNCERTAINTY_PHRASES = ("not found", "unclear", "don't know", "cannot find", "no information")
+
+
+def _build_phrase_automaton(phrases):
+    """Aho-Corasick automaton matching all phrases in one pass, or None without pyahocorasick"""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for phrase in phrases:
+        automaton.add_word(phrase, phrase)
+    automaton.make_automaton()
+    return automaton
+
+
+_UNCERTAINTY_AUTOMATON = _build_phrase_automaton(_UNCERTAINTY_PHRASES)
+
+
+def has_uncertainty_phrase(text_lower: str) -> bool:
+    """True if the (lowercased) text contains any uncertainty phrase"""
+    if _UNCERTAINTY_AUTOMATON is not None:
+        return next(_UNCERTAINTY_AUTOMATON.iter(text_lower), None) is not None
+    return any(phrase in text_lower for phrase in _UNCERTAINTY_PHRASES)
+
+
+@functools.lru_cache(maxsize=4096)
+def chunk_tokens(page_content: str) -> frozenset:
+    """Lowercased word tokens of a chunk, cached so repeated retrievals skip re-tokenizing"""
+    return frozenset(_WORD_RE.findall(page_content.lower()))
+
+
+def retrieval_factors(
+    retrieved_docs: List[LangchainDocument],
+    question: str
+) -> Tuple[float, float]:
+    """
+    Answer-independent confidence factors, (retrieval_score, overlap).
+    Computed separately so they can run while the LLM generates the answer.
+    """
+    # Factor 1: Average retrieval score (if available in metadata)
+    retrieval_score = 0.0
+    if hasattr(retrieved_docs[0], 'metadata') and 'score' in retrieved_docs[0].metadata:
+        scores = [doc.metadata.get('score', 0) for doc in retrieved_docs]
+        retrieval_score = sum(scores) / len(scores) if scores else 0
+    else:
+        retrieval_score = 0.8
     
-    return text_splitter.split_documents(documents)
+    # Factor 3: Keyword overlap (set intersection over word tokens)
+    question_keywords = set(_WORD_RE.findall(question.lower()))
+    source_tokens = frozenset().union(*(chunk_tokens(doc.page_content) for doc in retrieved_docs))
+    overlap = len(question_keywords & source_tokens) / max(len(question_keywords), 1)
+    
+    return retrieval_score, overlap
 
 
 def calculate_confidence(
     retrieved_docs: List[LangchainDocument],
     answer: str,
-    question: str
+    question: str,
+    factors: Optional[Tuple[float, float]] = None
 ) -> float:
     """
     Multi-factor confidence scoring:
@@ -136,31 +599,20 @@ def calculate_confidence(
     2. Answer length/completeness
     3. Source agreement
     4. Keyword overlap
+    `factors` may carry precomputed retrieval_factors() output.
     """
     if not retrieved_docs:
         return 0.0
     
-    # Factor 1: Average retrieval score (if available in metadata)
-    retrieval_score = 0.0
-    if hasattr(retrieved_docs[0], 'metadata') and 'score' in retrieved_docs[0].metadata:
-        scores = [doc.metadata.get('score', 0) for doc in retrieved_docs]
-        retrieval_score = sum(scores) / len(scores) if scores else 0
-    else:
-        retrieval_score = 0.8
+    retrieval_score, overlap = factors or retrieval_factors(retrieved_docs, question)
     
     # Factor 2: Answer completeness
     completeness_score = 0.0
     if answer and len(answer) > 10:
         completeness_score = min(len(answer) / 100, 1.0)
     
-    # Factor 3: Keyword overlap
-    question_keywords = set(question.lower().split())
-    source_text = " ".join([doc.page_content for doc in retrieved_docs]).lower()
-    overlap = len([k for k in question_keywords if k in source_text]) / max(len(question_keywords), 1)
-    
     # Factor 4: Uncertainty penalty
-    uncertainty_phrases = ["not found", "unclear", "don't know", "cannot find", "no information"]
-    uncertainty_penalty = 0.3 if any(phrase in answer.lower() for phrase in uncertainty_phrases) else 0
+    uncertainty_penalty = 0.3 if has_uncertainty_phrase(answer.lower()) else 0
     
     confidence = (
         retrieval_score * 0.4 +
@@ -171,16 +623,166 @@ def calculate_confidence(
     return max(0.0, min(1.0, confidence))
 
 
+def build_context(retrieved_docs: List[LangchainDocument]) -> str:
+    """Concatenate the top chunks, each capped, to bound prompt size"""
+    return "\n---\n".join(
+        doc.page_content[:CONTEXT_CHARS_PER_CHUNK] for doc in retrieved_docs[:RETRIEVAL_K]
+    )
+
+
+def confidence_guardrail(confidence: float) -> Dict[str, Any]:
+    """Response metadata for the low-confidence guardrail"""
+    if confidence < CONFIDENCE_THRESHOLD:
+        return {"guardrail": "low_confidence", "original_confidence": confidence}
+    return {"guardrail": "passed"}
+
+
+def format_sources(source_docs: List[LangchainDocument]) -> List[str]:
+    """Short source excerpts returned alongside an answer"""
+    return [doc.page_content[:200] + "..." for doc in source_docs[:3]]
+
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format a server-sent event; data is JSON-encoded so newlines in tokens are safe"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+
 @app.on_event("startup")
 async def startup_event():
     """Startup event - embeddings loaded lazily on first use"""
     print("Embeddings will load on first document upload")
 
 
+def _document_lock(document_id: str) -> threading.Lock:
+    with _documents_lock:
+        return _document_locks[document_id]
+
+
+def _ingest(tmp_path: str, filename: str, document_id: Optional[str], file_hash: str):
+    """
+    Load, chunk and embed a document. Blocking; run via asyncio.to_thread.
+    Returns (document_id, chunk texts, reused) where reused means the exact
+    same file was already indexed. Without a document_id, an identical file
+    already indexed under some document is reused, else a new ID is issued.
+    Concurrent uploads of the same document_id are serialised, so their
+    read-diff-delete-add sequences never interleave.
+    """
+    if document_id is None:
+        for candidate in _documents_with_hash(file_hash):
+            with _document_lock(candidate):
+                chunk_texts = _indexed_texts(candidate, file_hash)
+            if chunk_texts is not None:
+                print(f"✅ Reused {len(chunk_texts)} indexed chunks for unchanged file")
+                return candidate, chunk_texts, True
+        document_id = uuid.uuid4().hex
+    
+    with _document_lock(document_id):
+        chunk_texts, reused = _index_document(tmp_path, filename, document_id, file_hash)
+    return document_id, chunk_texts, reused
+
+
+def _documents_with_hash(file_hash: str) -> List[str]:
+    """IDs of documents with at least one chunk from this exact file"""
+    hits = get_vector_store().get(where={"file_hash": file_hash}, include=["metadatas"])
+    return list(dict.fromkeys(m["doc"] for m in hits["metadatas"]))
+
+
+def _indexed_texts(document_id: str, file_hash: str) -> Optional[List[str]]:
+    """
+    Chunk texts of a document in document order if it is fully indexed from
+    this exact file, else None. Caller holds the document's lock.
+    """
+    indexed = get_vector_store().get(where={"doc": document_id}, include=["documents", "metadatas"])
+    if not indexed["ids"] or any(m.get("file_hash") != file_hash for m in indexed["metadatas"]):
+        return None
+    ordered = sorted(
+        zip(indexed["metadatas"], indexed["documents"]),
+        key=lambda item: item[0].get("chunk_index", 0)
+    )
+    return [text for _, text in ordered]
+
+
+def _batched(ids: List[str], size: int) -> List[List[str]]:
+    """Split ids into consecutive lists of at most size"""
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+def _index_document(tmp_path: str, filename: str, document_id: str, file_hash: str):
+    """Body of _ingest; caller holds the document's lock"""
+    print("📦 Loading embeddings model...")
+    store = get_vector_store()
+    
+    # Same bytes already indexed under this document: skip load, chunk and embed entirely
+    chunk_texts = _indexed_texts(document_id, file_hash)
+    if chunk_texts is not None:
+        print(f"✅ Reused {len(chunk_texts)} indexed chunks for unchanged file")
+        return chunk_texts, True
+    existing_ids = set(store.get(where={"doc": document_id}, include=[])["ids"])
+    
+    # Load document
+    loaded_docs = load_document(tmp_path, filename)
+    
+    # Chunk document
+    chunks = chunk_document(loaded_docs)
+    for chunk in chunks:
+        chunk.metadata["doc"] = document_id
+        chunk.metadata["filename"] = filename
+        # Lets extraction pick the chunks it needs without fetching every chunk's text
+        chunk.metadata["chunk_chars"] = len(chunk.page_content)
+        chunk.metadata["file_hash"] = file_hash
+    
+    # Key chunks by content hash; identical chunks within a document collapse to one
+    by_id = {}
+    for chunk in chunks:
+        by_id.setdefault(chunk_id(document_id, chunk.page_content), chunk)
+    # Chroma returns chunks in insertion order, which an incremental replace
+    # scrambles; record each chunk's position in the document instead
+    for index, chunk in enumerate(by_id.values()):
+        chunk.metadata["chunk_index"] = index
+    
+    # Add first, then restamp, then delete: if embedding fails part-way, the
+    # stored chunks still carry the old file_hash and a retry re-ingests
+    
+    # Chroma rejects writes larger than the client's max batch size
+    batch_size = store._client.get_max_batch_size()
+    
+    # Only embed chunks that are not already stored
+    new_ids = [i for i in by_id if i not in existing_ids]
+    for batch in _batched(new_ids, batch_size):
+        store.add_documents(documents=[by_id[i] for i in batch], ids=batch)
+    
+    # Reused chunks keep their embedding; only their metadata moves to the new file
+    reused_ids = [i for i in by_id if i in existing_ids]
+    for batch in _batched(reused_ids, batch_size):
+        store._collection.update(ids=batch, metadatas=[by_id[i].metadata for i in batch])
+    
+    # Drop chunks from a previous version of this document that no longer exist
+    stale_ids = list(existing_ids - by_id.keys())
+    for batch in _batched(stale_ids, batch_size):
+        store.delete(ids=batch)
+    print(f"✅ Indexed {len(new_ids)} new chunks ({len(reused_ids)} reused)")
+    
+    # Same deduplicated set the reuse path returns, so both report equal counts
+    return [chunk.page_content for chunk in by_id.values()], False
+
+
 @app.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
-    """Upload and process a logistics document"""
-    global vector_store, current_document_name
+async def upload_document(
+    file: UploadFile = File(...),
+    document_id: Optional[str] = Form(None)
+):
+    """
+    Upload and process a logistics document.
+    Re-uploading a file that is already indexed returns its existing
+    document_id and skips processing. Pass an existing document_id to
+    replace that document; unchanged chunks are reused.
+    """
+    
+    # Opening the store restores documents indexed before a restart
+    await asyncio.to_thread(get_vector_store)
+    if document_id is not None and document_id not in documents:
+        raise HTTPException(status_code=404, detail=f"Document not found: {document_id}")
     
     allowed_extensions = ['pdf', 'docx', 'doc', 'txt']
     file_ext = file.filename.split('.')[-1].lower()
@@ -190,57 +792,84 @@ async def upload_document(file: UploadFile = File(...)):
             detail=f"File type not supported. Allowed: {', '.join(allowed_extensions)}"
         )
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_ext}') as tmp:
-        content = await file.read()
-        tmp.write(content)
+    # Stream the upload to disk in fixed-size chunks so memory stays bounded,
+    # hashing as we go to recognise files that were already processed
+    hasher = hashlib.blake2b(digest_size=16)
+    with tempfile.NamedTemporaryFile(
+        delete=False, suffix=f'.{file_ext}', buffering=UPLOAD_CHUNK_SIZE
+    ) as tmp:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            tmp.write(chunk)
         tmp_path = tmp.name
+    file_hash = hasher.hexdigest()
     
     try:
-        # Load document
-        documents = load_document(tmp_path, file.filename)
-        
-        # Chunk document
-        chunks = chunk_document(documents)
-        
-        # Create vector store with lazy-loaded embeddings (2025 import: langchain_chroma)
-        print("📦 Loading embeddings model...")
-        vector_store = Chroma.from_documents(
-            documents=chunks,
-            embedding=get_embeddings(),
-            collection_name="logistics_docs"
+        # Load, chunk and embed off the event loop so other requests keep being served
+        document_id, chunk_texts, reused = await asyncio.to_thread(
+            _ingest, tmp_path, file.filename, document_id, file_hash
         )
-        print("✅ Vector store created successfully")
         
-        current_document_name = file.filename
+        with _documents_lock:
+            if reused:
+                # Reused chunks keep the filename they were indexed under
+                documents.setdefault(document_id, file.filename)
+            else:
+                documents[document_id] = file.filename
+            filename = documents[document_id]
+            STATE.latest_document_id = document_id
+        if not reused:
+            # Cached and in-flight answers may refer to a previous version of this document
+            invalidate_cached_answers(document_id)
         
         return {
             "message": "Document uploaded and processed successfully",
-            "filename": file.filename,
-            "chunks_created": len(chunks),
-            "total_characters": sum(len(chunk.page_content) for chunk in chunks)
+            "document_id": document_id,
+            "filename": filename,
+            "chunks_created": len(chunk_texts),
+            "total_characters": sum(len(text) for text in chunk_texts),
+            "reused": reused
         }
     
     finally:
         os.unlink(tmp_path)
 
 
+async def generate_answer(llm: ChatGoogleGenerativeAI, prompt: str) -> Tuple[str, bool]:
+    """Returns (answer, failed); errors become the answer text instead of raising"""
+    try:
+        response = await llm.ainvoke(prompt)
+        return response.content, False
+    except Exception as e:
+        return f"Error generating answer: {str(e)}", True
+
+
 @app.post("/ask", response_model=AnswerResponse)
 async def ask_question(request: QuestionRequest):
-    """Ask a question about the uploaded document"""
-    global vector_store
+    """Ask a question about an uploaded document"""
+    document_id = await resolve_document(request.document_id)
+    cache_generation = qa_cache_generation[document_id]
     
-    if vector_store is None:
-        raise HTTPException(
-            status_code=400,
-            detail="No document uploaded. Please upload a document first."
-        )
-    
-    retriever = vector_store.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 4}
+    # Semantic cache: skip retrieval and the LLM call for near-duplicate questions
+    question_vec = np.asarray(
+        await asyncio.to_thread(get_embeddings().embed_query, request.question),
+        dtype=np.float32
     )
+    question_vec /= max(float(np.linalg.norm(question_vec)), 1e-12)
+    cached = lookup_cached_answer(document_id, question_vec)
+    if cached is not None:
+        return cached.model_copy(update={"metadata": {**cached.metadata, "cache_hit": True}})
     
-    retrieved_docs = retriever.get_relevant_documents(request.question)
+    # Reuse the question embedding rather than embedding the question a second time
+    # MMR drops near-duplicate chunks that would only inflate the prompt
+    retrieved_docs = await asyncio.to_thread(
+        STATE.vector_store.max_marginal_relevance_search_by_vector,
+        question_vec.tolist(),
+        k=RETRIEVAL_K,
+        fetch_k=MMR_FETCH_K,
+        lambda_mult=MMR_LAMBDA,
+        filter={"doc": document_id}
+    )
     
     # Guardrail: Check if we have any relevant context
     if not retrieved_docs:
@@ -252,96 +881,137 @@ async def ask_question(request: QuestionRequest):
         )
     
     # Initialize LLM (using Gemini)
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0,
-        google_api_key=os.getenv("GEMINI_API_KEY")
-    )
-    
-    # Create RAG prompt (using langchain_core.prompts)
-    prompt_template = """You are an AI assistant helping with logistics document analysis.
-
-Answer the question based ONLY on the following context from the document. If the answer is not in the context, say "Not found in document".
-
-Context:
-{context}
-
-Question: {question}
-
-Answer (be specific and cite relevant details):"""
+    llm = get_llm(max_output_tokens=ASK_MAX_OUTPUT_TOKENS)
     
-    prompt = PromptTemplate(
-        template=prompt_template,
-        input_variables=["context", "question"]
-    )
+    # Get answer from the already-retrieved chunks (no second retrieval)
+    source_docs = retrieved_docs
+    prompt = RAG_PROMPT.format(context=build_context(retrieved_docs), question=request.question)
     
-    # Create QA chain
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        chain_type_kwargs={"prompt": prompt},
-        return_source_documents=True
+    # Generate the answer while the answer-independent confidence factors are computed
+    (answer, llm_failed), factors = await asyncio.gather(
+        generate_answer(llm, prompt),
+        asyncio.to_thread(retrieval_factors, source_docs, request.question)
     )
     
-    # Get answer
-    try:
-        result = qa_chain({"query": request.question})
-        answer = result["result"]
-        source_docs = result.get("source_documents", retrieved_docs)
-    except Exception as e:
-        answer = f"Error generating answer: {str(e)}"
-        source_docs = retrieved_docs
-    
     # Calculate confidence
-    confidence = calculate_confidence(source_docs, answer, request.question)
+    confidence = calculate_confidence(source_docs, answer, request.question, factors)
     
     # Guardrail: Low confidence threshold
-    CONFIDENCE_THRESHOLD = 0.3
-    if confidence < CONFIDENCE_THRESHOLD:
+    metadata = confidence_guardrail(confidence)
+    if metadata["guardrail"] == "low_confidence":
         answer = f"[Low confidence] {answer}\n\nNote: This answer may not be reliable. Please verify with the source document."
-        metadata = {"guardrail": "low_confidence", "original_confidence": confidence}
-    else:
-        metadata = {"guardrail": "passed"}
     
-    # Extract sources
-    sources = [doc.page_content[:200] + "..." for doc in source_docs[:3]]
+    sources = format_sources(source_docs)
     
-    return AnswerResponse(
+    response = AnswerResponse(
         answer=answer,
         sources=sources,
         confidence=round(confidence, 3),
         metadata=metadata
     )
+    if not llm_failed:
+        store_cached_answer(document_id, question_vec, response, cache_generation)
+    
+    return response
 
 
-@app.post("/extract", response_model=StructuredData)
-async def extract_structured_data():
-    """Extract structured shipment data from the document"""
-    global vector_store
+@app.post("/ask/stream")
+async def ask_question_stream(request: QuestionRequest):
+    """
+    Ask a question and stream the answer as server-sent events.
+    Emits `data: {"token": ...}` events, then a final `done` event with
+    sources, confidence and metadata.
+    """
+    document_id = await resolve_document(request.document_id)
     
-    if vector_store is None:
-        raise HTTPException(
-            status_code=400,
-            detail="No document uploaded. Please upload a document first."
-        )
+    retriever = STATE.vector_store.as_retriever(
+        search_type="mmr",
+        search_kwargs={
+            "k": RETRIEVAL_K,
+            "fetch_k": MMR_FETCH_K,
+            "lambda_mult": MMR_LAMBDA,
+            "filter": {"doc": document_id}
+        }
+    )
+    retrieved_docs = await retriever.ainvoke(request.question)
     
-    # Get all document content
-    all_docs = vector_store.get()
-    full_text = " ".join([doc for doc in all_docs['documents']])
+    llm = get_llm(max_output_tokens=ASK_MAX_OUTPUT_TOKENS)
+    chain = RAG_PROMPT | llm | StrOutputParser()
+    context = build_context(retrieved_docs)
     
-    # Initialize LLM
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0,
-        google_api_key=os.getenv("GEMINI_API_KEY")
+    async def generate():
+        # Guardrail: Check if we have any relevant context
+        if not retrieved_docs:
+            answer = "Not found in document - no relevant information available."
+            yield sse_event({"token": answer})
+            yield sse_event(
+                {"sources": [], "confidence": 0.0, "metadata": {"guardrail": "no_context_found"}},
+                event="done",
+            )
+            return
+        
+        # Answer-independent confidence factors overlap with generation
+        factors_task = asyncio.create_task(
+            asyncio.to_thread(retrieval_factors, retrieved_docs, request.question)
+        )
+        
+        parts = []
+        try:
+            async for token in chain.astream({"context": context, "question": request.question}):
+                parts.append(token)
+                yield sse_event({"token": token})
+        except Exception as e:
+            factors_task.cancel()
+            yield sse_event({"error": f"Error generating answer: {str(e)}"}, event="error")
+            return
+        
+        # Confidence needs the full answer, so it is sent after the last token
+        confidence = calculate_confidence(
+            retrieved_docs, "".join(parts), request.question, await factors_task
+        )
+        yield sse_event(
+            {
+                "sources": format_sources(retrieved_docs),
+                "confidence": round(confidence, 3),
+                "metadata": confidence_guardrail(confidence),
+            },
+            event="done",
+        )
+    
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+def get_document_text(document_id: str, max_chars: int = EXTRACT_CONTEXT_CHARS) -> str:
+    """Chunk text of one document in document order, joined until max_chars is reached"""
+    # Order by metadata alone, then fetch text only for the chunks that fit
+    indexed = STATE.vector_store.get(where={"doc": document_id}, include=["metadatas"])
+    ordered = sorted(
+        zip(indexed['metadatas'], indexed['ids']),
+        key=lambda item: item[0].get("chunk_index", 0)
     )
     
-    # Extraction prompt
-    extraction_prompt = f"""Extract the following shipment information from this logistics document. Return ONLY valid JSON with these exact fields. Use null for missing information.
+    ids = []
+    total = 0
+    for metadata, cid in ordered:
+        ids.append(cid)
+        # Chunks indexed before chunk_chars was recorded count as empty, so they are all fetched
+        total += metadata.get("chunk_chars", 0) + 1
+        if total >= max_chars:
+            break
+    if not ids:
+        return ""
+    
+    fetched = STATE.vector_store.get(ids=ids, include=["documents"])
+    text_by_id = dict(zip(fetched['ids'], fetched['documents']))
+    return " ".join(text_by_id.get(i, "") for i in ids)[:max_chars]
+
+
+def build_extraction_prompt(full_text: str) -> str:
+    """Extraction prompt"""
+    return f"""Extract the following shipment information from this logistics document. Return ONLY valid JSON with these exact fields. Use null for missing information.
 
 Document text:
-{full_text[:4000]}
+{full_text[:EXTRACT_CONTEXT_CHARS]}
 
 Required JSON format:
 {{
@@ -359,24 +1029,190 @@ Required JSON format:
 }}
 
 Return ONLY the JSON, no other text:"""
+
+
+def extract_json_object(text: str) -> Optional[str]:
+    """
+    Return the first complete top-level {...} span in text, or None.
+    Single pass tracking brace depth; braces inside JSON strings are ignored.
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
     
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+def parse_structured_data(result_text: str) -> StructuredData:
+    """Parse the LLM's JSON reply; unparseable replies yield an empty record"""
     try:
-        response = llm.invoke(extraction_prompt)
-        result_text = response.content
-        
         # Extract JSON from response
-        json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-        if json_match:
-            extracted_data = json.loads(json_match.group())
-        else:
-            extracted_data = json.loads(result_text)
+        json_text = extract_json_object(result_text)
+        extracted_data = json.loads(json_text if json_text is not None else result_text)
         
         return StructuredData(**extracted_data)
     
+    except Exception:
+        return StructuredData()
+
+
+@app.post("/extract", response_model=StructuredData)
+async def extract_structured_data(request: Optional[ExtractRequest] = None):
+    """Extract structured shipment data from an uploaded document"""
+    document_id = await resolve_document(request.document_id if request else None)
+    
+    # Get all document content
+    full_text = await asyncio.to_thread(get_document_text, document_id)
+    
+    # Initialize LLM
+    llm = get_llm()
+    
+    try:
+        response = await llm.ainvoke(build_extraction_prompt(full_text))
+        return parse_structured_data(response.content)
+    
     except Exception as e:
         return StructuredData()
 
 
+def get_genai_client():
+    """Lazily create the google-genai client used for the Batch API"""
+    if STATE.genai_client is None:
+        try:
+            from google import genai
+        except ImportError:
+            raise HTTPException(
+                status_code=500,
+                detail="Batch extraction requires the google-genai package."
+            )
+        STATE.genai_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return STATE.genai_client
+
+
+def _submit_extraction_batch(document_ids: List[str]) -> str:
+    """Write one extraction request per document to JSONL and submit it. Blocking."""
+    # Raises the HTTPException guard first if google-genai is missing
+    client = get_genai_client()
+    from google.genai import types
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".jsonl") as tmp:
+        for document_id in document_ids:
+            request = {
+                "contents": [{"parts": [{"text": build_extraction_prompt(get_document_text(document_id))}]}],
+                # Pure JSON output: no prose wrapper to generate or strip.
+                # Temperature 0 matches the synchronous /extract client
+                "generation_config": {"response_mime_type": "application/json", "temperature": 0}
+            }
+            tmp.write(json.dumps({"key": document_id, "request": request}) + "\n")
+        tmp_path = tmp.name
+    
+    try:
+        uploaded = client.files.upload(
+            file=tmp_path,
+            config=types.UploadFileConfig(display_name="extract-batch", mime_type="jsonl")
+        )
+    finally:
+        os.unlink(tmp_path)
+    
+    batch_job = client.batches.create(
+        model="gemini-2.5-flash",
+        src=uploaded.name,
+        config={"display_name": "extract-batch"}
+    )
+    return batch_job.name
+
+
+def _fetch_extraction_batch(batch_name: str) -> Dict[str, Any]:
+    """Poll a batch job and parse its results once it has succeeded. Blocking."""
+    # Succeeded jobs are final; don't download and parse the output again
+    cached = batch_results.get(batch_name)
+    if cached is not None:
+        return {"state": "JOB_STATE_SUCCEEDED", "results": cached}
+    
+    client = get_genai_client()
+    batch_job = client.batches.get(name=batch_name)
+    state = batch_job.state.name
+    
+    # document_id -> StructuredData, or {"error": message} for items that failed
+    results: Dict[str, Any] = {}
+    if state == "JOB_STATE_SUCCEEDED":
+        output = client.files.download(file=batch_job.dest.file_name).decode("utf-8")
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if "error" in item:
+                error = item["error"]
+                results[item["key"]] = {"error": error.get("message", str(error)) if isinstance(error, dict) else str(error)}
+                continue
+            try:
+                text = item["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            except (KeyError, IndexError):
+                # e.g. a blocked prompt: a response with no candidates
+                results[item["key"]] = {"error": "No extraction returned for this document."}
+                continue
+            results[item["key"]] = parse_structured_data(text)
+        batch_results[batch_name] = results
+    
+    return {"state": state, "results": results}
+
+
+@app.post("/extract/batch")
+async def extract_structured_data_batch(request: BatchExtractRequest):
+    """
+    Submit structured extraction for several uploaded documents to the
+    Gemini Batch API (half price, higher rate limits, not interactive).
+    Poll GET /extract/batch/{job_id} for results.
+    """
+    # Repeated IDs would become duplicate JSONL keys and collapse in the results
+    document_ids = list(dict.fromkeys(request.document_ids))
+    if not document_ids:
+        raise HTTPException(status_code=400, detail="No documents given.")
+    
+    for document_id in document_ids:
+        await resolve_document(document_id)
+    
+    batch_name = await asyncio.to_thread(_submit_extraction_batch, document_ids)
+    job_id = uuid.uuid4().hex
+    batch_jobs[job_id] = batch_name
+    
+    return {
+        "job_id": job_id,
+        "batch_name": batch_name,
+        "document_ids": document_ids
+    }
+
+
+@app.get("/extract/batch/{job_id}")
+async def get_extraction_batch(job_id: str):
+    """Get the state of a batch extraction job, with results once it has succeeded"""
+    batch_name = batch_jobs.get(job_id)
+    if batch_name is None:
+        raise HTTPException(status_code=404, detail="Batch job not found.")
+    
+    job = await asyncio.to_thread(_fetch_extraction_batch, batch_name)
+    return {"job_id": job_id, "batch_name": batch_name, **job}
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for deployment platforms"""
@@ -384,20 +1220,24 @@ async def health_check():
         "status": "healthy",
         "service": "ultra-doc-intelligence",
         "version": "2.0.0",
-        "embeddings_loaded": embeddings is not None
+        "embeddings_loaded": STATE.embeddings is not None
     }
 
 
 @app.get("/status")
 async def get_status():
     """Get system status"""
+    # Opening the store restores documents indexed before a restart
+    await asyncio.to_thread(get_vector_store)
     return {
         "status": "online",
         "version": "2.0.0",
-        "document_loaded": current_document_name is not None,
-        "current_document": current_document_name,
-        "vector_store_initialized": vector_store is not None,
-        "embeddings_loaded": embeddings is not None
+        "document_loaded": bool(documents),
+        "current_document": documents.get(STATE.latest_document_id),
+        "current_document_id": STATE.latest_document_id,
+        "documents_loaded": len(documents),
+        "vector_store_initialized": STATE.vector_store is not None,
+        "embeddings_loaded": STATE.embeddings is not None
     }
 
 
@@ -412,7 +1252,10 @@ async def root():
         "endpoints": {
             "upload": "POST /upload - Upload a document",
             "ask": "POST /ask - Ask questions about the document",
+            "ask_stream": "POST /ask/stream - Stream the answer as server-sent events",
             "extract": "POST /extract - Extract structured data",
+            "extract_batch": "POST /extract/batch - Batch-extract structured data from several documents",
+            "extract_batch_status": "GET /extract/batch/{job_id} - Poll a batch extraction job",
             "status": "GET /status - Check system status",
             "health": "GET /health - Health check"
         }